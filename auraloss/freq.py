@@ -1,11 +1,58 @@
 import torch
 import numpy as np
 import librosa.filters
+from functools import lru_cache
 from .utils import apply_reduction
 
 from .perceptual import SumAndDifference, FIRFilter
 
 
+@lru_cache(maxsize=64)
+def _filterbank(scale, sample_rate, fft_size, n_bins):
+    """Return the (cached) mel or chroma filterbank (n_bins, fft_size // 2 + 1).
+
+    Only the NumPy array is cached, each loss builds its own tensor from it.
+    """
+    if scale == "mel":
+        fb = librosa.filters.mel(sr=sample_rate, n_fft=fft_size, n_mels=n_bins)
+    elif scale == "chroma":
+        fb = librosa.filters.chroma(sr=sample_rate, n_fft=fft_size, n_chroma=n_bins)
+    else:
+        raise ValueError(f"Invalid scale: '{scale}'.")
+    return fb
+
+
+def _dft_basis(window, n_fft):
+    """Windowed real DFT basis as conv1d weights (2 * (n_fft // 2 + 1), 1, n_fft).
+
+    The window is zero-padded on both sides to n_fft, as in torch.stft.
+    """
+    assert window.numel() <= n_fft  # window must fit in the FFT size, as in torch.stft
+    left = (n_fft - window.numel()) // 2
+    window = torch.nn.functional.pad(window, (left, n_fft - window.numel() - left))
+    k = torch.arange(n_fft // 2 + 1).unsqueeze(1)
+    n = torch.arange(n_fft).unsqueeze(0)
+    kn = (k * n) % n_fft  # reduce before scaling for accuracy
+    angle = 2 * np.pi * kn.double() / n_fft
+    sin = torch.sin(angle)
+    sin[(2 * kn) % n_fft == 0] = 0.0  # exact zeros, as in the DC/Nyquist bins of an FFT
+    basis = torch.cat([torch.cos(angle), -sin]) * window
+    return basis.to(window.dtype).unsqueeze(1)
+
+
+def _conv_stft(x, basis, n_fft, hop_size):
+    """Centered STFT of (B, T) signals as a strided convolution with a DFT basis.
+
+    Matches torch.stft(..., center=True, pad_mode="reflect", return_complex=True).
+    """
+    x = torch.nn.functional.pad(
+        x.unsqueeze(1), (n_fft // 2, n_fft // 2), mode="reflect"
+    )
+    x_stft = torch.nn.functional.conv1d(x, basis.to(x.dtype), stride=hop_size)
+    real, imag = x_stft.chunk(2, dim=1)
+    return torch.complex(real, imag)
+
+
 class SpectralConvergenceLoss(torch.nn.Module):
     """Spectral convergence loss module.
 
@@ -16,7 +63,8 @@ class SpectralConvergenceLoss(torch.nn.Module):
         super(SpectralConvergenceLoss, self).__init__()
 
     def forward(self, x_mag, y_mag):
-        return torch.norm(y_mag - x_mag, p="fro") / torch.norm(y_mag, p="fro")
+        # 2-norm over the flattened tensors, equal to the Frobenius norm
+        return torch.linalg.norm(y_mag - x_mag) / torch.linalg.norm(y_mag)
 
 
 class STFTMagnitudeLoss(torch.nn.Module):
@@ -35,18 +83,23 @@ class STFTMagnitudeLoss(torch.nn.Module):
     def __init__(self, log=True, distance="L1", reduction="mean"):
         super(STFTMagnitudeLoss, self).__init__()
         self.log = log
-        if distance == "L1":
-            self.distance = torch.nn.L1Loss(reduction=reduction)
-        elif distance == "L2":
-            self.distance = torch.nn.MSELoss(reduction=reduction)
-        else:
+        if distance not in ["L1", "L2"]:
             raise ValueError(f"Invalid distance: '{distance}'.")
+        self.distance = distance
+        self.reduction = reduction
 
     def forward(self, x_mag, y_mag):
         if self.log:
-            x_mag = torch.log(x_mag)
-            y_mag = torch.log(y_mag)
-        return self.distance(x_mag, y_mag)
+            # log(x) - log(y) as a single log of the ratio
+            diff = torch.log(x_mag / y_mag)
+        else:
+            diff = x_mag - y_mag
+
+        if self.distance == "L1":
+            losses = diff.abs()
+        else:
+            losses = diff ** 2
+        return apply_reduction(losses, reduction=self.reduction)
 
 
 class STFTLoss(torch.nn.Module):
@@ -81,7 +134,13 @@ class STFTLoss(torch.nn.Module):
             'mean': the sum of the output will be divided by the number of elements in the output,
             'sum': the output will be summed.
             Default: 'mean'
-        device (str, optional): Place the filterbanks on specified device. Default: None
+        device (str, optional): Place the window and filterbanks on specified device. Default: None
+        bfloat16 (bool, optional): Compute the magnitude loss terms in bfloat16. The STFT
+            and phase are kept in full precision and the losses are returned in the
+            input dtype. Default: False
+        use_compile (bool, optional): Compile the loss computation with torch.compile (torch >= 2.0),
+            specialized on the settings of this instance. Changing them afterwards (e.g. the
+            hop size in RandomResolutionSTFTLoss) triggers recompilation. Default: False
 
     Returns:
         loss:
@@ -108,12 +167,21 @@ class STFTLoss(torch.nn.Module):
         output="loss",
         reduction="mean",
         device=None,
+        bfloat16=False,
+        use_compile=False,
     ):
         super(STFTLoss, self).__init__()
         self.fft_size = fft_size
         self.hop_size = hop_size
         self.win_length = win_length
-        self.window = getattr(torch, window)(win_length)
+        window = getattr(torch, window)(win_length)
+        self.register_buffer("window", window, persistent=False)
+        # small FFTs run faster as a convolution with a windowed DFT basis
+        if fft_size <= 32:
+            dft_basis = _dft_basis(self.window, fft_size)
+            self.register_buffer("dft_basis", dft_basis, persistent=False)
+        else:
+            self.dft_basis = None
         self.w_sc = w_sc
         self.w_log_mag = w_log_mag
         self.w_lin_mag = w_lin_mag
@@ -126,6 +194,7 @@ class STFTLoss(torch.nn.Module):
         self.output = output
         self.reduction = reduction
         self.device = device
+        self.bfloat16 = bfloat16
 
         self.spectralconv = SpectralConvergenceLoss()
         self.logstft = STFTMagnitudeLoss(log=True, reduction=reduction)
@@ -135,16 +204,19 @@ class STFTLoss(torch.nn.Module):
         if self.scale == "mel":
             assert sample_rate != None  # Must set sample rate to use mel scale
             assert n_bins <= fft_size  # Must be more FFT bins than Mel bins
-            fb = librosa.filters.mel(sample_rate, fft_size, n_mels=n_bins)
-            self.fb = torch.tensor(fb).unsqueeze(0)
         elif self.scale == "chroma":
             assert sample_rate != None  # Must set sample rate to use chroma scale
             assert n_bins <= fft_size  # Must be more FFT bins than chroma bins
-            fb = librosa.filters.chroma(sample_rate, fft_size, n_chroma=n_bins)
-            self.fb = torch.tensor(fb).unsqueeze(0)
 
-        if scale is not None and device is not None:
-            self.fb = self.fb.to(self.device)  # move filterbank to device
+        if scale is not None:
+            fb = torch.from_numpy(_filterbank(scale, sample_rate, fft_size, n_bins))
+            self.register_buffer("fb", fb, persistent=False)
+
+        if device is not None:
+            self.to(device)  # move window and filterbank to device
+
+        self.use_compile = use_compile
+        self._compiled_loss = None  # built on first use, see _forward_flat
 
     def stft(self, x):
         """Perform STFT.
@@ -154,36 +226,87 @@ class STFTLoss(torch.nn.Module):
         Returns:
             Tensor: x_mag, x_phs
                 Magnitude and phase spectra (B, fft_size // 2 + 1, frames).
+                The phase is None when the phase loss is disabled (w_phs = 0).
         """
-        x_stft = torch.stft(
-            x,
-            self.fft_size,
-            self.hop_size,
-            self.win_length,
-            self.window,
-            return_complex=True,
-        )
-        x_mag = torch.sqrt(
-            torch.clamp((x_stft.real ** 2) + (x_stft.imag ** 2), min=self.eps)
-        )
-        x_phs = torch.angle(x_stft)
+        if self.dft_basis is not None:
+            x_stft = _conv_stft(x, self.dft_basis, self.fft_size, self.hop_size)
+        else:
+            x_stft = torch.stft(
+                x,
+                self.fft_size,
+                self.hop_size,
+                self.win_length,
+                self.window,
+                return_complex=True,
+            )
+        # same as sqrt(clamp(real ** 2 + imag ** 2, eps)) in a single kernel,
+        # complex abs() has a zero (not NaN) gradient at the origin unlike hypot()
+        x_mag = torch.clamp(x_stft.abs(), min=self.eps ** 0.5)
+        x_phs = torch.angle(x_stft) if self.w_phs else None
         return x_mag, x_phs
 
-    def forward(self, x, y):
-        # compute the magnitude and phase spectra of input and target
-        self.window = self.window.to(x.device)
-        x_mag, x_phs = self.stft(x.view(-1, x.size(-1)))
-        y_mag, y_phs = self.stft(y.view(-1, y.size(-1)))
+    def _spectra(self, x):
+        """Compute the (optionally rescaled) magnitude and phase spectra.
+        Args:
+            x (Tensor): Input signal tensor (B, T).
+
+        Returns:
+            Tensor: x_mag, x_phs
+                Magnitude spectra (B, n_bins, frames) when scale is set,
+                and phase spectra (B, fft_size // 2 + 1, frames) or None.
+        """
+        x_mag, x_phs = self.stft(x)
+
+        if self.bfloat16:
+            x_mag = x_mag.bfloat16()
 
         # apply relevant transforms
         if self.scale is not None:
-            x_mag = torch.matmul(self.fb, x_mag)
-            y_mag = torch.matmul(self.fb, y_mag)
+            x_mag = torch.matmul(self.fb.to(x_mag.dtype), x_mag)
+
+        return x_mag, x_phs
+
+    def forward(self, x, y):
+        # reshape is a free view for contiguous inputs and only copies otherwise
+        x = x.reshape(-1, x.size(-1))
+        y = y.reshape(-1, y.size(-1))
+        return self._forward_flat(x, y)
+
+    def __getstate__(self):
+        # the compiled function is not picklable, it is rebuilt after loading
+        state = self.__dict__.copy()
+        state["_compiled_loss"] = None
+        return state
+
+    def _forward_flat(self, x, y):
+        """Compute the loss from input and target signals flattened to (B, T)."""
+        if not self.use_compile:
+            return self._loss(x, y)
+        if self._compiled_loss is None:
+            self._compiled_loss = torch.compile(
+                self._loss, fullgraph=True, dynamic=True
+            )
+        return self._compiled_loss(x, y)
+
+    def _loss(self, x, y):
+        # compute the magnitude and phase spectra of input and target
+        if x.shape == y.shape and x.requires_grad == y.requires_grad:
+            # a single STFT over input and target stacked along the batch
+            xy_mag, xy_phs = self._spectra(torch.cat([x, y], dim=0))
+            x_mag, y_mag = xy_mag.chunk(2, dim=0)
+            x_phs, y_phs = xy_phs.chunk(2, dim=0) if self.w_phs else (None, None)
+        else:
+            # stacking needs matching shapes, and would backpropagate through
+            # both STFTs when only one of the signals requires gradients
+            x_mag, x_phs = self._spectra(x)
+            y_mag, y_phs = self._spectra(y)
 
         # normalize scales
         if self.scale_invariance:
-            alpha = (x_mag * y_mag).sum([-2, -1]) / ((y_mag ** 2).sum([-2, -1]))
-            y_mag = y_mag * alpha.unsqueeze(-1)
+            # per-example <x, y> / <y, y>, the norm avoids a squared temporary
+            alpha = (x_mag * y_mag).sum([-2, -1])
+            alpha = alpha / torch.linalg.norm(y_mag, dim=(-2, -1)) ** 2
+            y_mag = y_mag * alpha.view(-1, 1, 1)
 
         # compute loss terms
         sc_mag_loss = self.spectralconv(x_mag, y_mag) if self.w_sc else 0.0
@@ -191,6 +314,12 @@ class STFTLoss(torch.nn.Module):
         lin_mag_loss = self.linstft(x_mag, y_mag) if self.w_lin_mag else 0.0
         phs_loss = torch.nn.functional.mse_loss(x_phs, y_phs) if self.w_phs else 0.0
 
+        if self.bfloat16:  # return the magnitude terms in the input precision
+            sc_mag_loss, log_mag_loss, lin_mag_loss = [
+                term.to(x.dtype) if torch.is_tensor(term) else term
+                for term in (sc_mag_loss, log_mag_loss, lin_mag_loss)
+            ]
+
         # combine loss terms
         loss = (
             (self.w_sc * sc_mag_loss)
@@ -295,6 +424,9 @@ class MultiResolutionSTFTLoss(torch.nn.Module):
             Default: None
         n_bins (int, optional): Number of mel frequency bins. Required when scale = 'mel'. Default: None.
         scale_invariance (bool, optional): Perform an optimal scaling of the target. Default: False
+        use_streams (bool, optional): On CUDA, run each resolution on its own stream so the
+            STFTs can overlap. Memory is then not reused between resolutions, which
+            raises the peak memory use. Default: False
     """
 
     def __init__(
@@ -311,6 +443,7 @@ class MultiResolutionSTFTLoss(torch.nn.Module):
         scale=None,
         n_bins=None,
         scale_invariance=False,
+        use_streams=False,
         **kwargs,
     ):
         super(MultiResolutionSTFTLoss, self).__init__()
@@ -339,22 +472,67 @@ class MultiResolutionSTFTLoss(torch.nn.Module):
                 )
             ]
 
+        self.use_streams = use_streams
+        self._streams = {}  # CUDA streams per device, created on first use
+
+    def __getstate__(self):
+        # streams are not picklable, they are recreated on first use
+        state = self.__dict__.copy()
+        state["_streams"] = {}
+        return state
+
+    def _resolution_losses(self, x, y):
+        """Compute the loss of every resolution for flattened signals (B, T).
+
+        With use_streams on CUDA each resolution runs on its own stream so
+        that the independent STFTs can overlap, joined back to the current stream.
+        """
+        if not (self.use_streams and x.is_cuda):
+            return [f._forward_flat(x, y) for f in self.stft_losses]
+
+        if x.device not in self._streams:
+            self._streams[x.device] = [
+                torch.cuda.Stream(device=x.device) for _ in self.stft_losses
+            ]
+        streams = self._streams[x.device]
+        current_stream = torch.cuda.current_stream(x.device)
+
+        losses = []
+        for f, stream in zip(self.stft_losses, streams):
+            stream.wait_stream(current_stream)  # inputs must be ready
+            with torch.cuda.stream(stream):
+                losses.append(f._forward_flat(x, y))
+
+        for stream in streams:
+            current_stream.wait_stream(stream)
+        # results are consumed (and freed) on the current stream
+        for loss in losses:
+            for term in loss if isinstance(loss, tuple) else (loss,):
+                if torch.is_tensor(term):
+                    term.record_stream(current_stream)
+
+        return losses
+
     def forward(self, x, y):
-        mrstft_loss = 0.0
+        mrstft_loss = []
         sc_mag_loss, log_mag_loss, lin_mag_loss, phs_loss = [], [], [], []
 
-        for f in self.stft_losses:
+        # flatten once, shared by all resolutions
+        x = x.reshape(-1, x.size(-1))
+        y = y.reshape(-1, y.size(-1))
+
+        for f, tmp_loss in zip(self.stft_losses, self._resolution_losses(x, y)):
             if f.output == "full":  # extract just first term
-                tmp_loss = f(x, y)
-                mrstft_loss += tmp_loss[0]
+                mrstft_loss.append(tmp_loss[0])
                 sc_mag_loss.append(tmp_loss[1])
                 log_mag_loss.append(tmp_loss[2])
                 lin_mag_loss.append(tmp_loss[3])
                 phs_loss.append(tmp_loss[4])
             else:
-                mrstft_loss += f(x, y)
+                mrstft_loss.append(tmp_loss)
 
-        mrstft_loss /= len(self.stft_losses)
+        # average over resolutions in a single reduction
+        mrstft_loss = torch.stack(mrstft_loss).mean(dim=0)
 
         if f.output == "loss":
             return mrstft_loss
@@ -416,13 +594,19 @@ class RandomResolutionSTFTLoss(torch.nn.Module):
         self.sample_rate = sample_rate
         self.scale = scale
         self.n_mels = n_mels
+        self.kwargs = kwargs
+
+        # STFT losses are built once per (fft size, window length, window)
+        # and reused by later randomizations, only the hop size is redrawn
+        self.pool = torch.nn.ModuleDict()
 
         self.nforwards = 0
         self.randomize_losses()  # init the losses
 
-    def randomize_losses(self):
-        # clear the existing STFT losses
-        self.stft_losses = torch.nn.ModuleList()
+    def randomize_losses(self, device=None):
+        # draw new STFT losses from the pool
+        self.stft_losses = []
+        self.hop_sizes = []
         for n in range(self.resolutions):
             frame_size = 2 ** np.random.randint(
                 np.log2(self.min_fft_size), np.log2(self.max_fft_size)
@@ -436,22 +620,30 @@ class RandomResolutionSTFTLoss(torch.nn.Module):
             )
             window_length = int(frame_size * np.random.choice([1.0, 0.5, 0.25]))
             window = np.random.choice(self.windows)
-            self.stft_losses += [
-                STFTLoss(
-                    frame_size,
-                    hop_size,
-                    window_length,
-                    window,
-                    self.w_sc,
-                    self.w_log_mag,
-                    self.w_lin_mag,
-                    self.w_phs,
-                    self.sample_rate,
-                    self.scale,
-                    self.n_mels,
-                    **kwargs,
-                )
-            ]
+
+            key = f"{frame_size}_{window_length}_{window}"
+            # pooled losses outlive this call, so their buffers must not be
+            # inference tensors even when randomizing under inference mode
+            with torch.inference_mode(False):
+                if key not in self.pool:
+                    self.pool[key] = STFTLoss(
+                        frame_size,
+                        hop_size,
+                        window_length,
+                        window,
+                        self.w_sc,
+                        self.w_log_mag,
+                        self.w_lin_mag,
+                        self.w_phs,
+                        self.sample_rate,
+                        self.scale,
+                        self.n_mels,
+                        **self.kwargs,
+                    )
+                if device is not None:
+                    self.pool[key].to(device)  # entries may predate the device
+            self.stft_losses.append(self.pool[key])
+            self.hop_sizes.append(hop_size)
 
     def forward(self, input, target):
         if input.size(-1) <= self.max_fft_size:
@@ -464,12 +656,13 @@ class RandomResolutionSTFTLoss(torch.nn.Module):
             )
 
         if self.nforwards % self.randomize_rate == 0:
-            self.randomize_losses()
+            self.randomize_losses(device=input.device)
 
-        loss = 0.0
-        for f in self.stft_losses:
-            loss += f(input, target)
-        loss /= len(self.stft_losses)
+        losses = []
+        for f, hop_size in zip(self.stft_losses, self.hop_sizes):
+            f.hop_size = hop_size
+            losses.append(f(input, target))
+        loss = torch.stack(losses).mean(dim=0)
 
         self.nforwards += 1
 
@@ -39,3 +39,46 @@ loss = auraloss.freq.STFTLoss(w_log_mag=1.0, w_lin_mag=1.0, w_sc=0.0, reduction=
 res = loss(pred, target)
 print(res.shape)
 assert len(res.shape) > 1
+
+# test random resolution STFT, reusing pooled losses across randomizations
+loss = auraloss.freq.RandomResolutionSTFTLoss(randomize_rate=1)
+for _ in range(3):
+    res = loss(pred, target)
+print(res, res.shape)
+assert res is not None
+
+# test small FFT sizes, computed with a DFT convolution
+loss = auraloss.freq.STFTLoss(fft_size=32, hop_size=8, win_length=16)
+x = pred.view(-1, pred.size(-1))
+x_mag, _ = loss.stft(x)
+ref_mag = torch.stft(x, 32, 8, 16, loss.window, return_complex=True).abs()
+assert torch.allclose(x_mag, ref_mag.clamp(min=loss.eps ** 0.5), atol=1e-4)
+
+# test scale invariance
+loss = auraloss.freq.STFTLoss(scale_invariance=True)
+res = loss(pred, target)
+print(res, res.shape)
+assert res is not None
+
+# test non-contiguous inputs
+loss = auraloss.freq.MultiResolutionSTFTLoss()
+res = loss(pred[..., ::2], target[..., ::2])
+print(res, res.shape)
+assert res is not None
+
+# test a target of different length and batch size
+loss = auraloss.freq.STFTLoss()
+res = loss(pred[..., :8000], target[..., :7999])
+assert res is not None
+res = loss(pred, target[:1, :1])  # broadcast over the batch
+assert res is not None
+
+# test random resolution losses pooled under inference mode used in training
+loss = auraloss.freq.RandomResolutionSTFTLoss(max_fft_size=1024)
+with torch.inference_mode():
+    for _ in range(20):
+        loss(pred, target)
+x = pred.clone().requires_grad_(True)
+for _ in range(3):
+    loss(x, target).backward()
+assert x.grad is not None